@@ -1,22 +1,36 @@
 import os
 import re
 import cgi
+import sys
 import json
+import mmap
+import zlib
 import yaml
 import copy
+import time
 import fcntl
 import flask
+import errno
+import atexit
+import select
+import socket
+import struct
 import base64
 import sqlite3
 import pymysql
 import hashlib
 import functools
+import threading
 
 config = """
 mysql:
     host: 127.0.0.1
     user: root
     password:
+    pool_size: 4
+    max_lifetime: 3600
+    ping_interval: 30
+    skip_locked: false
 
 agents:
     127.0.0.1:
@@ -25,11 +39,37 @@ agents:
 logs:
     server: 127.0.0.1:5000
     dir: /tmp/logs
+    block: 65536
+    compact_after: 3
+
+counters:
+    flush_interval: 10
+    flush_count: 1000
+
+timers:
+    tick: 1
+
+storage:
+    compress: 1024
+
+# Opt-in per app (wait). Each waiter holds a gunicorn worker, size -w to match.
+longpoll:
+    timeout: 20
+    interval: 1
+    dir: /tmp/shepherd.notify
+    max_waiters: 1
+    host_waiters: 0
 
 apps:
     100001:
         key: sha1sum(appid:key)
         pythonpath: /usr/bin/python
+        batch: 1
+        wait: 0
+        # Imported by the zygote before it forks workers (default none).
+        preload:
+            - sheep
+            - sheepdog
         hosts:
             127.0.0.1:
                 workflows: 10
@@ -51,6 +91,14 @@ create table locks(
     unique(lockname, appid, workerid)
 ) engine=innodb;
 create index lock1 on locks(appid, workerid, lockname);
+create index lock2 on locks(appid, lockname, sequence);
+
+create table lockwaits(
+    appid     char(32)        not null,
+    workerid  bigint unsigned not null,
+    missing   int             not null,
+    primary key(appid, workerid)
+) engine=innodb;
 
 create table workers(
     workerid     bigint unsigned primary key auto_increment,
@@ -59,6 +107,7 @@ create table workers(
     status       longblob,
     continuation longblob,
     session      int unsigned not null default 0,
+    head         bigint unsigned,
     timestamp    timestamp default current_timestamp,
     created      timestamp
 ) engine=innodb;
@@ -77,9 +126,18 @@ create table messages(
     timestamp timestamp default current_timestamp
 ) engine=innodb;
 
-create index msg1 on messages(timestamp, state, lock_ip, appid, pool);
+create index ready1 on messages(state, lock_ip, appid, pool, priority, msgid);
+create index timer1 on messages(state, timestamp);
 create index msg2 on messages(appid, workerid, msgid);
 
+create table agents(
+    ip        char(15)     not null,
+    appid     char(32)     not null,
+    workers   int unsigned not null,
+    timestamp timestamp default current_timestamp,
+    primary key(ip, appid)
+) engine=innodb;
+
 create table counters(
     appid     char(32) primary key,
     count     bigint,
@@ -90,10 +148,22 @@ create table counters(
 conf_file = '/tmp/shepherd.yaml'
 
 conf = None
+conf_cache = dict(stat=None, conf=None, agent_keys=dict(), app_keys=dict(),
+                  derived_keys=dict(), verified=set())
 clientip = None
 appid = None
 req = None
+notify_appids = set()
+locked_workers = dict()
 
+db_pool = None
+autoinc = None
+timers_ticked = 0
+waiters = 0
+waiters_lock = threading.Lock()
+
+# Lock wait timeout, deadlock and lost connection: safe to retry.
+retryable_errors = (1205, 1213, 2006, 2013)
 db_conn = None
 db_cursor = None
 
@@ -121,23 +191,376 @@ def json_response(status, obj=None):
                           mimetype='application/json')
 
 
+def encode(obj):
+    """Prefix 1 is compact JSON, 2 is zlib; older rows are plain JSON."""
+    raw = json.dumps(obj, separators=(',', ':'))
+
+    threshold = int(((conf or {}).get('storage') or {}).get('compress', 1024))
+    if len(raw) > threshold:
+        return '\x02' + zlib.compress(raw)
+
+    return '\x01' + raw
+
+
+def decode(blob):
+    if blob is None:
+        return None
+
+    if '\x01' == blob[:1]:
+        return json.loads(blob[1:])
+
+    if '\x02' == blob[:1]:
+        return json.loads(zlib.decompress(blob[1:]))
+
+    return json.loads(blob)
+
+
 def html_table_response(table):
     return flask.Response(
         '<table class="logs" align="center" border="1">{0}</table>'.format(
             table), 200, mimetype='text/html')
 
 
+def html_table_stream(rows):
+    def generate():
+        yield '<table class="logs" align="center" border="1">'
+        for row in rows:
+            yield row
+        yield '</table>'
+
+    return flask.Response(generate(), 200, mimetype='text/html')
+
+
+def json_list_stream(items, trailer):
+    def generate():
+        yield '{"items": ['
+        for n, item in enumerate(items):
+            yield (',\n' if n else '\n') + json.dumps(item, sort_keys=True)
+        yield '\n], ' + json.dumps(trailer, sort_keys=True)[1:]
+
+    return flask.Response(generate(), 200, mimetype='application/json')
+
+
 def login_response():
     return flask.Response(
         '401 Not Authorized', 401,
         {'WWW-Authenticate': 'Basic realm="Login Required"'})
 
 
+def get_config():
+    global conf_cache
+
+    st = os.stat(conf_file)
+    stat = (st.st_ino, st.st_mtime, st.st_size)
+    if stat == conf_cache['stat']:
+        return conf_cache['conf']
+
+    c = yaml.load(open(conf_file))
+
+    agent_keys = dict([(ip, a['key'])
+                       for ip, a in (c.get('agents') or {}).iteritems()])
+    app_keys = dict([(app, a['key'])
+                     for app, a in (c.get('apps') or {}).iteritems()])
+
+    derived_keys = dict()
+    for ip, agent_key in agent_keys.iteritems():
+        for app, app_key in app_keys.iteritems():
+            derived_keys[(ip, app)] = hashlib.sha1('{0}:{1}'.format(
+                agent_key, app_key)).hexdigest()
+
+    conf_cache = dict(stat=stat, conf=c, agent_keys=agent_keys,
+                      app_keys=app_keys, derived_keys=derived_keys,
+                      verified=set())
+    return c
+
+
+def authenticate(appid, password, clientip):
+    if (appid, password) in conf_cache['verified']:
+        return True
+
+    agent_keys, app_keys = conf_cache['agent_keys'], conf_cache['app_keys']
+
+    authSuccess = False
+    if (appid in agent_keys) or (appid in app_keys):
+        h = hashlib.sha1('{0}:{1}'.format(appid, password)).hexdigest()
+        if h == agent_keys.get(appid):
+            authSuccess = True
+        elif h == app_keys.get(appid):
+            authSuccess = True
+
+    if authSuccess:
+        if len(conf_cache['verified']) > 10000:
+            conf_cache['verified'].clear()
+        conf_cache['verified'].add((appid, password))
+        return True
+
+    return password == conf_cache['derived_keys'].get((clientip, appid))
+
+
+class Counters(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.apps = dict()
+        self.endpoints = dict()
+        self.pending = 0
+        self.flushed = time.time()
+
+    def record(self, appid, endpoint, status, msec):
+        with self.lock:
+            self.apps[appid] = self.apps.get(appid, 0) + 1
+            self.pending += 1
+
+            e = self.endpoints.setdefault(endpoint, dict(
+                count=0, errors=0, msec=0, max_msec=0))
+            e['count'] += 1
+            e['msec'] += msec
+            e['max_msec'] = max(e['max_msec'], msec)
+            if 200 != status:
+                e['errors'] += 1
+
+    def due(self):
+        c = dict(flush_interval=10, flush_count=1000)
+        c.update(conf.get('counters') or {})
+
+        return (self.pending >= int(c['flush_count'])) or (
+            time.time() - self.flushed >= float(c['flush_interval']))
+
+    def flush(self, cursor):
+        with self.lock:
+            apps, self.apps = self.apps, dict()
+            self.pending = 0
+            self.flushed = time.time()
+
+        if not apps:
+            return
+
+        try:
+            cursor.execute("""insert into counters(appid, count) values {0}
+                              on duplicate key update count=count+values(count)
+                           """.format(','.join(['(%s, %s)'] * len(apps))),
+                           [v for item in apps.iteritems() for v in item])
+            cursor.connection.commit()
+        except Exception:
+            cursor.connection.rollback()
+            with self.lock:
+                for a, count in apps.iteritems():
+                    self.apps[a] = self.apps.get(a, 0) + count
+                    self.pending += count
+            raise
+
+    def statistics(self):
+        with self.lock:
+            endpoints = dict()
+            for name, e in self.endpoints.iteritems():
+                endpoints[name] = dict(e, avg_msec=e['msec'] / e['count'])
+
+            return dict(pid=os.getpid(), unflushed=dict(self.apps),
+                        endpoints=endpoints)
+
+
+counters = Counters()
+
+
+@atexit.register
+def flush_counters():
+    if (not counters.apps) or (db_pool is None) or (
+            db_pool.pid != os.getpid()):
+        return
+
+    conn = db_pool.get()
+    try:
+        cursor = conn.cursor()
+        counters.flush(cursor)
+        cursor.close()
+    finally:
+        db_pool.put(conn)
+
+
+def longpoll_conf():
+    c = dict(timeout=20, interval=1, dir='/tmp/shepherd.notify',
+             max_waiters=1, host_waiters=0)
+    c.update(conf.get('longpoll') or {})
+    return c
+
+
+def notify(appid):
+    notify_appids.add(str(appid))
+
+
+def wakeup(appids):
+    notify_dir = longpoll_conf()['dir']
+    if not os.path.isdir(notify_dir):
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    try:
+        for name in os.listdir(notify_dir):
+            if name.split('.')[0] not in appids:
+                continue
+
+            path = os.path.join(notify_dir, name)
+            try:
+                sock.sendto('x', path)
+            except socket.error as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+    finally:
+        sock.close()
+
+
+class Listener(object):
+    def __init__(self, appid):
+        notify_dir = longpoll_conf()['dir']
+        if not os.path.isdir(notify_dir):
+            try:
+                os.makedirs(notify_dir)
+            except OSError:
+                pass
+
+        self.path = os.path.join(notify_dir, '{0}.{1}.{2}'.format(
+            appid, os.getpid(), threading.current_thread().ident))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        self.sock.bind(self.path)
+
+    def wait(self, timeout):
+        if select.select([self.sock], [], [], max(timeout, 0))[0]:
+            try:
+                while self.sock.recv(64):
+                    pass
+            except socket.error:
+                pass
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
 def query(sql, params=None):
     db_cursor.execute(sql, params)
     return db_cursor.fetchall()
 
 
+class ConnectionPool(object):
+    def __init__(self, mysql):
+        self.params = (mysql['host'], mysql['user'], mysql['password'])
+        self.size = int(mysql.get('pool_size', 4))
+        self.max_lifetime = int(mysql.get('max_lifetime', 3600))
+        self.ping_interval = int(mysql.get('ping_interval', 30))
+        self.timeout = int(mysql.get('pool_timeout', 30))
+
+        self.pid = os.getpid()
+        self.cond = threading.Condition()
+        self.idle = list()
+        self.created = dict()
+        self.busy = 0
+        self.stats = dict(created=0, reused=0, expired=0, broken=0,
+                          waits=0, timeouts=0)
+
+    def close(self, conn):
+        self.created.pop(conn, None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def get(self):
+        deadline = time.time() + self.timeout
+        with self.cond:
+            while True:
+                while self.idle:
+                    conn, last_used = self.idle.pop()
+                    now = time.time()
+
+                    if now - self.created[conn] > self.max_lifetime:
+                        self.stats['expired'] += 1
+                        self.close(conn)
+                        continue
+
+                    if now - last_used > self.ping_interval:
+                        try:
+                            conn.ping(False)
+                        except Exception:
+                            self.stats['broken'] += 1
+                            self.close(conn)
+                            continue
+
+                    self.busy += 1
+                    self.stats['reused'] += 1
+                    return conn
+
+                if self.busy < self.size:
+                    self.busy += 1
+                    break
+
+                if time.time() > deadline:
+                    self.stats['timeouts'] += 1
+                    throw(503, 'DB_POOL_EXHAUSTED')
+
+                self.stats['waits'] += 1
+                self.cond.wait(deadline - time.time())
+
+        try:
+            conn = pymysql.connect(self.params[0], self.params[1],
+                                   self.params[2], 'shepherd')
+        except Exception:
+            self.put(None)
+            raise
+
+        with self.cond:
+            self.created[conn] = time.time()
+            self.stats['created'] += 1
+        return conn
+
+    def put(self, conn, broken=False):
+        with self.cond:
+            self.busy -= 1
+            if conn is not None:
+                if broken:
+                    self.stats['broken'] += 1
+                    self.close(conn)
+                else:
+                    self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def drain(self):
+        with self.cond:
+            while self.idle:
+                self.close(self.idle.pop()[0])
+
+    def statistics(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats.update(pid=self.pid, size=self.size, busy=self.busy,
+                         idle=len(self.idle), open=len(self.created))
+        return stats
+
+
+def get_pool(mysql):
+    global db_pool
+
+    params = (mysql['host'], mysql['user'], mysql['password'])
+
+    # A forked worker must not use its parent's connections.
+    if (db_pool is None) or (db_pool.pid != os.getpid()):
+        db_pool = ConnectionPool(mysql)
+    elif db_pool.params != params:
+        db_pool.drain()
+        db_pool = ConnectionPool(mysql)
+
+    return db_pool
+
+
 def transaction(*args, **kwargs):
     def fun(f):
         @application.route(*args, **kwargs)
@@ -149,6 +572,8 @@ def transaction(*args, **kwargs):
             global clientip
             global appid
             global req
+            global notify_appids
+            global locked_workers
 
             clientip = flask.request.headers.get('X-Real-IP',
                                                  flask.request.remote_addr)
@@ -158,60 +583,58 @@ def transaction(*args, **kwargs):
             appid = flask.request.authorization['username']
             password = flask.request.authorization['password']
 
-            conf = yaml.load(open(conf_file))
+            conf = get_config()
 
-            authSuccess = False
             appid = int(appid) if appid.isdigit() else appid
-
-            if appid in conf['agents']:
-                h = hashlib.sha1('{0}:{1}'.format(appid, password)).hexdigest()
-                if h == conf['agents'][appid]['key']:
-                    authSuccess = True
-
-            if appid in conf['apps']:
-                h = hashlib.sha1('{0}:{1}'.format(appid, password)).hexdigest()
-                if h == conf['apps'][appid]['key']:
-                    authSuccess = True
-                elif clientip in conf['agents']:
-                    h = hashlib.sha1('{0}:{1}'.format(
-                        conf['agents'][clientip]['key'],
-                        conf['apps'][appid]['key'])).hexdigest()
-                    if h == password:
-                        authSuccess = True
-
-            if not authSuccess:
+            if not authenticate(appid, password, clientip):
                 return login_response()
 
-            db_conn = pymysql.connect(conf['mysql']['host'],
-                                      conf['mysql']['user'],
-                                      conf['mysql']['password'],
-                                      'shepherd')
-            db_cursor = db_conn.cursor(pymysql.cursors.DictCursor)
-
             req = json.loads(flask.request.data) if flask.request.data else {}
+            notify_appids = set()
+            locked_workers = dict()
+
+            pool = get_pool(conf['mysql'])
+            try:
+                db_conn = pool.get()
+            except CustomException as e:
+                return json_response(e.response, e.status)
 
-            query("""insert into counters values(%s, 0, null)
-                     on duplicate key update count=count+1""", (appid))
+            db_cursor = db_conn.cursor(pymysql.cursors.DictCursor)
 
+            start_time = time.time()
             try:
                 response = f(*args, **kwargs)
                 db_conn.commit()
                 status = 200
             except CustomException as e:
-                db_conn.rollback()
                 status = e.status
                 response = e.response
             except pymysql.err.InternalError as e:
-                db_conn.rollback()
                 status = 500
                 response = str(type(e)) + ' : ' + str(e)
+            except pymysql.err.OperationalError as e:
+                status = 500 if e.args[0] in retryable_errors else 400
+                response = str(type(e)) + ' : ' + str(e)
             except Exception as e:
-                db_conn.rollback()
                 status = 400
                 response = str(type(e)) + ' : ' + str(e)
 
-            db_cursor.close()
-            db_conn.close()
+            counters.record(appid, f.__name__, status,
+                            int((time.time() - start_time) * 1000))
+
+            broken = False
+            try:
+                if 200 != status:
+                    db_conn.rollback()
+                if counters.due():
+                    counters.flush(db_cursor)
+                db_cursor.close()
+            except Exception:
+                broken = True
+            pool.put(db_conn, broken)
+
+            if (200 == status) and notify_appids:
+                wakeup(notify_appids)
 
             if type(response) is flask.Response:
                 return response
@@ -226,16 +649,27 @@ def counters_get():
     return query("select * from counters")
 
 
+# Per server process, like /pool.
+@transaction('/counters/stats', methods=['GET'])
+def counters_stats_get():
+    return counters.statistics()
+
+
+@transaction('/pool', methods=['GET'])
+def pool_get():
+    return db_pool.statistics()
+
+
 @transaction('/tasks/<tmpid>', methods=['GET'])
 def tasks_appid_get(tmpid):
     tmpid = int(tmpid) if tmpid.isdigit() else tmpid
     if appid != tmpid:
         return login_response()
 
+    promote_timers()
     msgs = query("""select workerid, pool, code, priority, timestamp
                     from messages
-                    where timestamp < now() and
-                          state='head' and
+                    where state='head' and
                           lock_ip is null and
                           appid=%s
                     order by timestamp, priority""", (appid))
@@ -248,10 +682,11 @@ def tasks_appid_get(tmpid):
 
 @transaction('/tasks', methods=['GET'])
 def tasks_get():
+    promote_timers()
+
     msgs = query("""select appid, count(*) as count
                     from messages
-                    where timestamp < now() and
-                          state='head' and
+                    where state='head' and
                           lock_ip is null
                     group by appid""")
     return html_table_response(''.join([
@@ -273,7 +708,7 @@ def locks_appid_get(tmpid):
     return html_table_response(''.join([
         ('<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td>' +
          '<td><a href="/unlock/{1}/{0}">unlock</a></td></tr>').format(
-             m['lockname'], m['workerid'], m['status'],
+             m['lockname'], m['workerid'], decode(m['status']),
              m['timestamp']) for m in msgs]))
 
 
@@ -287,117 +722,449 @@ def locks_get():
             m['appid'], m['appid'], m['count']) for m in msgs]))
 
 
+def place(count, hosts):
+    """Fill hosts, a list of (ip, capacity, load), least loaded first."""
+    hosts = [h for h in hosts if h[1] > 0]
+    if not hosts:
+        return dict()
+
+    def filled(level):
+        return sum([max(0, min(level - load, capacity))
+                    for ip, capacity, load in hosts])
+
+    count = min(count, sum([h[1] for h in hosts]))
+
+    low = min([h[2] for h in hosts])
+    high = max([h[1] + h[2] for h in hosts])
+    while low < high:
+        mid = (low + high + 1) // 2
+        if filled(mid) <= count:
+            low = mid
+        else:
+            high = mid - 1
+
+    allocation = dict()
+    remaining = count - filled(low)
+    for ip, capacity, load in hosts:
+        n = max(0, min(low - load, capacity))
+        if (remaining > 0) and (load <= low < load + capacity):
+            n += 1
+            remaining -= 1
+        if n > 0:
+            allocation[ip] = n
+
+    return allocation
+
+
 @transaction('/pending', methods=['GET'])
 def pending_get():
+    if (appid in conf['agents']) and ('workers' in (req or {})):
+        query("delete from agents where ip=%s", (appid))
+        if req['workers']:
+            query("insert into agents(ip, appid, workers) values " +
+                  ','.join(['(%s, %s, %s)'] * len(req['workers'])),
+                  [v for a, n in req['workers'].iteritems()
+                   for v in (appid, a, n)])
+
+    live = dict()
+    load = dict()
+    for r in query("""select ip, appid, workers from agents
+                      where timestamp > now() - interval 60 second"""):
+        live[(r['ip'], r['appid'])] = r['workers']
+        load[r['ip']] = load.get(r['ip'], 0) + r['workers']
+
+    promote_timers()
+
     msgs = query("""select appid, pool, count(*) as count
                     from messages
-                    where timestamp < now() and
-                          state='head' and lock_ip is null
+                    where state='head' and lock_ip is null
                     group by appid, pool""")
 
     allocation = dict()
     for m in msgs:
-        appid = int(m['appid']) if m['appid'].isdigit() else m['appid']
+        a = int(m['appid']) if m['appid'].isdigit() else m['appid']
 
-        if appid not in conf['apps']:
+        if a not in conf['apps']:
             continue
 
-        app = conf['apps'][appid]
+        app = conf['apps'][a]
 
         if 'default' == m['pool']:
-            ip_list = conf['apps'][appid]['hosts'].keys()
+            ip_list = app['hosts'].keys()
         else:
-            ip_list = conf['apps'][appid]['pools'].get(m['pool'], [])
-
-        while m['count'] > 0:
-            start_count = m['count']
-            for ip in ip_list:
-                allocation.setdefault(ip, dict()).setdefault(appid, 0)
-
-                if allocation[ip][appid] < app['hosts'][ip]['workflows']:
-                    allocation[ip][appid] += 1
-                    m['count'] -= 1
-                    if 0 == m['count']:
-                        break
-            if m['count'] == start_count:
-                break
+            ip_list = (app.get('pools') or {}).get(m['pool'], [])
+
+        # Load excludes this app's own workers, which are being placed.
+        hosts = list()
+        for ip in ip_list:
+            if ip not in app['hosts']:
+                continue
+
+            allocated = allocation.get(ip, {}).get(a, 0)
+            hosts.append((ip,
+                          app['hosts'][ip]['workflows'] - allocated,
+                          load.get(ip, 0) - live.get((ip, m['appid']), 0)))
+
+        for ip, n in place(m['count'], hosts).iteritems():
+            allocation.setdefault(ip, dict()).setdefault(a, 0)
+            allocation[ip][a] += n
 
     return allocation
 
 
+def autoinc_step():
+    global autoinc
+
+    # Consecutive ids are guaranteed only with innodb_autoinc_lock_mode < 2.
+    if autoinc is None:
+        row = query("""select @@innodb_autoinc_lock_mode as mode,
+                              @@auto_increment_increment as step""")[0]
+        autoinc = int(row['step']) if int(row['mode']) < 2 else 0
+
+    return autoinc
+
+
+def create_workers(specs):
+    workerids = list()
+    for i in range(0, len(specs), 1000):
+        chunk = specs[i:i+1000]
+
+        continuations = list()
+        for spec in chunk:
+            data = spec.get('data')
+            if 'workflow' in spec:
+                data = dict(workflow=spec['workflow'], input=data)
+            continuations.append(encode(data))
+
+        step = autoinc_step()
+        if step:
+            query("""insert into workers(appid, state, continuation,
+                                         status, created) values """ +
+                  ','.join(["(%s, 'active', %s, 'null', now())"] *
+                           len(chunk)),
+                  [v for c in continuations for v in (appid, c)])
+            ids = [db_cursor.lastrowid + n*step for n in range(len(chunk))]
+        else:
+            ids = list()
+            for c in continuations:
+                query("""insert into workers set appid=%s, state='active',
+                         continuation=%s, status='null', created=now()
+                      """, (appid, c))
+                ids.append(db_cursor.lastrowid)
+
+        query("""insert into messages(workerid, appid, senderid, pool,
+                                      state, priority, code) values """ +
+              ','.join(["(%s, %s, %s, %s, 'head', %s, 'init')"] * len(chunk)),
+              [v for w, spec in zip(ids, chunk)
+               for v in (w, appid, w, spec.get('pool', 'default'),
+                         spec.get('priority', 128))])
+        query("""update workers, messages set workers.head=messages.msgid
+                 where workers.workerid in %s and messages.appid=%s and
+                       messages.workerid=workers.workerid""", (ids, appid))
+
+        workerids.extend(ids)
+
+    notify(appid)
+    return workerids
+
+
 @transaction('/workers', methods=['POST'])
 def worker_post():
-    pool = req.get('pool', 'default')
-    priority = req.get('priority', 128)
+    if type(req) is list:
+        if len(req) > 10000:
+            throw(400, 'TOO_MANY_WORKERS')
 
-    if 'workflow' in req:
-        req['data'] = dict(workflow=req['workflow'], input=req['data'])
+        return create_workers(req)
 
-    query("""insert into workers set appid=%s, state='active',
-             continuation=%s, status='null', created=now()
-          """, (appid, json.dumps(req['data'], indent=4, sort_keys=True)))
-    workerid = query("select last_insert_id() as workerid")[0]['workerid']
-    query("""insert into messages
-             set workerid=%s, appid=%s, senderid=%s,
-                 pool=%s, state='head', priority=%s, code='init'
-          """, (workerid, appid, workerid, pool, priority))
-
-    return dict(workerid=workerid)
+    return dict(workerid=create_workers([req])[0])
 
 
 @transaction('/workers/<workerids>', methods=['GET'])
 def workers_get(workerids):
     log_server = conf['logs']['server']
 
-    result = dict()
-    for w in workerids.split(','):
-        rows = query("""select state, status, session from workers
-                        where workerid=%s and appid=%s""", (w, appid))
+    fields = set(['state', 'status', 'session', 'logs'])
+    if flask.request.args.get('fields'):
+        fields &= set(flask.request.args.get('fields').split(','))
+
+    columns = ['workerid'] + sorted(fields & set(['state', 'status',
+                                                  'session']))
+
+    ids = [w for w in workerids.split(',') if w.isdigit()]
 
-        if 1 == len(rows):
-            result[w] = dict(state=rows[0]['state'],
-                             status=json.loads(rows[0]['status']),
-                             session=rows[0]['session'],
-                             logs='http://{0}/logs/{1}'.format(log_server, w))
+    result = dict()
+    for i in range(0, len(ids), 500):
+        for row in query("""select {0} from workers
+                            where workerid in %s and appid=%s
+                         """.format(', '.join(columns)),
+                         (ids[i:i+500], appid)):
+            w = str(row['workerid'])
+
+            result[w] = dict()
+            if 'state' in fields:
+                result[w]['state'] = row['state']
+            if 'status' in fields:
+                result[w]['status'] = decode(row['status'])
+            if 'session' in fields:
+                result[w]['session'] = row['session']
+            if 'logs' in fields:
+                result[w]['logs'] = 'http://{0}/logs/{1}'.format(log_server,
+                                                                 w)
 
     return result
 
 
-def mark_head(workerid):
-    rows = query("select appid from workers where workerid=%s", (workerid))
-    if 1 != len(rows):
-        throw(400, 'INVALID_MSG_DESTINATION')
+def lock_workers(workerids):
+    # Once each, in workerid order, so commits queue instead of deadlocking.
+    ids = sorted(set([int(w) for w in workerids if str(w).isdigit()]) -
+                 set(locked_workers))
+    if not ids:
+        return
 
-    msgid = query("""select msgid from messages
-                     where appid=%s and workerid=%s
-                     order by msgid limit 1""", (rows[0]['appid'], workerid))
+    for row in query("""select workerid, appid, head from workers
+                        where workerid in %s order by workerid for update
+                     """, (ids,)):
+        locked_workers[row['workerid']] = row
 
-    if len(msgid) > 0:
-        query("""update messages set state='head'
-                 where msgid=%s""", (msgid[0]['msgid']))
 
+def next_lock_holders(locknames):
+    if not locknames:
+        return list()
 
-@transaction('/messages/<workerid>', methods=['POST'])
-def messages_post(workerid):
-    pool = req.get('pool', 'default')
-    priority = req.get('priority', 128)
-    data = req.get('data', None)
-    delay = req.get('delay', 0)
+    return [r['workerid'] for r in query(
+        """select locks.workerid
+           from locks, (select l.lockname, min(l.sequence) as sequence
+                        from locks l, (select lockname, min(sequence) as head
+                                       from locks
+                                       where appid=%s and lockname in %s
+                                       group by lockname) h
+                        where l.appid=%s and l.lockname=h.lockname and
+                              l.sequence > h.head
+                        group by l.lockname) nxt
+           where locks.sequence=nxt.sequence""",
+        (appid, list(set(locknames)), appid))]
 
-    if data:
-        data = json.dumps(data, indent=4, sort_keys=True)
 
-    rows = query("select appid from workers where workerid=%s", (workerid))
-    if (1 != len(rows)) or (rows[0]['appid'] != str(appid)):
+def commit_targets(item):
+    if type(item) is not dict:
+        return list()
+
+    targets = [item.get('workerid')]
+    if type(item.get('message')) is dict:
+        targets.extend(item['message'].keys())
+    if type(item.get('unlock')) is list:
+        targets.extend(next_lock_holders(item['unlock']))
+
+    return targets
+
+
+def push_message(workerid, senderid, pool, code, data=None, priority=128,
+                 delay=0, appid=None):
+    if not str(workerid).isdigit():
+        throw(400, 'INVALID_MSG_DESTINATION')
+
+    # Commits lock their targets up front.
+    lock_workers([workerid])
+    row = locked_workers.get(int(workerid))
+    if (row is None) or (appid and (row['appid'] != str(appid))):
         throw(400, 'INVALID_MSG_DESTINATION')
 
+    appid = row['appid']
+    if row['head']:
+        state = 'queued'
+    else:
+        state = 'timer' if int(delay) > 0 else 'head'
+
+    if data:
+        data = encode(data)
+
     query("""insert into messages
              set workerid=%s, appid=%s, senderid=%s,
-                 pool=%s, state='queued', priority=%s, code=%s, data=%s,
+                 pool=%s, state=%s, priority=%s, code=%s, data=%s,
                  timestamp=now()+interval %s second
-          """, (workerid, appid, 0, pool, priority, req['code'], data, delay))
+          """, (workerid, appid, senderid, pool, state, priority, code, data,
+                delay))
+
+    if 'queued' != state:
+        row['head'] = db_cursor.lastrowid
+        query("update workers set head=%s where workerid=%s",
+              (row['head'], workerid))
+    if 'head' == state:
+        notify(appid)
+
+
+def advance_head(workerid):
+    rows = query("""select msgid, timestamp > now() as future from messages
+                    where appid=%s and workerid=%s
+                    order by msgid limit 1 for update""", (appid, workerid))
+
+    head = rows[0]['msgid'] if rows else None
+    if head and rows[0]['future']:
+        query("update messages set state='timer' where msgid=%s", (head))
+    elif head:
+        query("update messages set state='head' where msgid=%s", (head))
+        notify(appid)
+
+    if int(workerid) in locked_workers:
+        locked_workers[int(workerid)]['head'] = head
+    query("update workers set head=%s where workerid=%s", (head, workerid))
+
+
+def promote_timers():
+    global timers_ticked
+
+    tick = float((conf.get('timers') or {}).get('tick', 1))
+    if time.time() - timers_ticked < tick:
+        return
+    timers_ticked = time.time()
+
+    # Own connection, so promoted rows are not held for the whole request.
+    pool = get_pool(conf['mysql'])
+    conn = pool.get()
+    broken = False
+    promoted = set()
+    try:
+        cursor = conn.cursor(pymysql.cursors.DictCursor)
+        cursor.execute("""select msgid, appid from messages
+                          where state='timer' and timestamp <= now()
+                          order by timestamp, msgid limit 1000""")
+        msgids = dict()
+        for row in cursor.fetchall():
+            msgids.setdefault(row['appid'], list()).append(row['msgid'])
+
+        for app, ids in msgids.iteritems():
+            if cursor.execute("""update messages set state='head'
+                                 where msgid in %s and state='timer'""",
+                              (ids,)):
+                promoted.add(app)
+        conn.commit()
+        cursor.close()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
+        raise
+    finally:
+        pool.put(conn, broken)
+
+    for app in promoted:
+        notify(app)
+
+
+def lock_holders(locknames):
+    if not locknames:
+        return dict()
+
+    rows = query("""select locks.lockname, locks.workerid
+                    from locks, (select lockname, min(sequence) as sequence
+                                 from locks
+                                 where appid=%s and lockname in %s
+                                 group by lockname) heads
+                    where locks.sequence=heads.sequence""",
+                 (appid, list(locknames)))
 
-    mark_head(workerid)
+    return dict([(r['lockname'], r['workerid']) for r in rows])
+
+
+def acquire_locks(workerid, locknames):
+    locknames = sorted(set(locknames))
+    workerid = int(workerid)
+
+    if not locknames:
+        return True
+
+    query("insert into locks(lockname, appid, workerid) values " +
+          ','.join(['(%s, %s, %s)'] * len(locknames)),
+          [v for l in locknames for v in (l, appid, workerid)])
+
+    holders = lock_holders(locknames)
+    missing = len([l for l in locknames if holders.get(l) != workerid])
+
+    if 0 == missing:
+        return True
+
+    # release_locks() counts missing down as the worker heads each lock.
+    query("""insert into lockwaits set appid=%s, workerid=%s, missing=%s
+             on duplicate key update missing=values(missing)
+          """, (appid, workerid, missing))
+    return False
+
+
+def release_locks(workerid, locknames):
+    workerid = int(workerid)
+
+    held = [r['lockname'] for r in query(
+        """select lockname from locks
+           where appid=%s and workerid=%s and lockname in %s
+        """, (appid, workerid, list(set(locknames))))] if locknames else []
+    if not held:
+        return set()
+
+    before = lock_holders(held)
+    query("""delete from locks
+             where appid=%s and workerid=%s and lockname in %s
+          """, (appid, workerid, held))
+    after = lock_holders(held)
+
+    progress = dict()
+    for lockname in held:
+        if before[lockname] == workerid:
+            if lockname in after:
+                w = after[lockname]
+                progress[w] = progress.get(w, 0) + 1
+        else:
+            progress[workerid] = progress.get(workerid, 0) + 1
+
+    if not progress:
+        return set()
+
+    # Locked so concurrent releases for one waiter apply in turn.
+    waiting = set([r['workerid'] for r in query(
+        """select workerid from lockwaits
+           where appid=%s and workerid in %s order by workerid for update
+        """, (appid, sorted(progress.keys())))])
+
+    by_count = dict()
+    for w, count in progress.iteritems():
+        if w in waiting:
+            by_count.setdefault(count, list()).append(w)
+
+    for count, workers in by_count.iteritems():
+        query("""update lockwaits set missing=missing-%s
+                 where appid=%s and workerid in %s""",
+              (count, appid, workers))
+
+    granted = set([r['workerid'] for r in query(
+        """select workerid from lockwaits
+           where appid=%s and workerid in %s and missing <= 0
+        """, (appid, list(waiting)))]) if waiting else set()
+    if granted:
+        query("delete from lockwaits where appid=%s and workerid in %s",
+              (appid, list(granted)))
+
+    # Waiters queued before lockwaits existed have no count.
+    legacy = [w for w in progress if (w not in waiting) and (w != workerid)]
+    if legacy:
+        rows = query("""select lockname, workerid from locks
+                        where appid=%s and workerid in %s""", (appid, legacy))
+        holders = lock_holders(set([r['lockname'] for r in rows]))
+        blocked = set([r['workerid'] for r in rows
+                       if holders.get(r['lockname']) != r['workerid']])
+        granted.update([w for w in legacy if w not in blocked])
+
+    return granted
+
+
+@transaction('/messages/<workerid>', methods=['POST'])
+def messages_post(workerid):
+    push_message(workerid, 0,
+                 req.get('pool', 'default'),
+                 req['code'],
+                 req.get('data', None),
+                 req.get('priority', 128),
+                 req.get('delay', 0),
+                 appid)
 
     return 'OK'
 
@@ -418,8 +1185,59 @@ def commit():
     return commit_impl()
 
 
+@transaction('/commits', methods=['POST'])
+def commits_post():
+    global req
+
+    items = req
+    result = list()
+
+    targets = list()
+    for item in items:
+        targets.extend(commit_targets(item))
+    lock_workers(targets)
+
+    try:
+        for item in items:
+            req = item
+
+            # Retryable errors still fail the whole batch.
+            query("savepoint commit_item")
+            try:
+                response = commit_impl()
+                query("release savepoint commit_item")
+                result.append(dict(msgid=item.get('msgid'), status=200,
+                                   response=response))
+            except CustomException as e:
+                query("rollback to savepoint commit_item")
+                result.append(dict(msgid=item.get('msgid'), status=e.status,
+                                   response=e.response))
+            except pymysql.err.DatabaseError as e:
+                if e.args and (e.args[0] in retryable_errors):
+                    raise
+                query("rollback to savepoint commit_item")
+                result.append(dict(msgid=item.get('msgid'), status=400,
+                                   response=str(type(e)) + ' : ' + str(e)))
+            except (KeyError, TypeError, ValueError) as e:
+                query("rollback to savepoint commit_item")
+                result.append(dict(msgid=item.get('msgid'), status=400,
+                                   response=str(type(e)) + ' : ' + str(e)))
+    finally:
+        req = items
+
+    return result
+
+
 def commit_impl():
+    # A rolled back item may have changed the cached heads.
+    locked_workers.clear()
+    lock_workers(commit_targets(req))
+
+    # Already committed, e.g. by a retry. /unlock commits msgid 0.
     pool = query("select pool from messages where msgid=%s", (req['msgid']))
+    if (not pool) and req['msgid']:
+        throw(404, 'MESSAGE_NOT_FOUND')
+
     query("delete from messages where msgid=%s", (req['msgid']))
 
     if 'pool' in req:
@@ -440,89 +1258,29 @@ def commit_impl():
 
         query("""delete from messages where appid=%s and workerid=%s""",
               (appid, req['workerid']))
-        query("""update workers set status=%s, continuation=null, state=%s
+        query("""update workers
+                 set status=%s, continuation=null, state=%s, head=null
                  where workerid=%s and appid=%s
-              """, (json.dumps(workflow_status, indent=4, sort_keys=True),
+              """, (encode(workflow_status),
                     workflow_state,
                     req['workerid'],
                     appid))
         return "OK"
 
-    def insert_message(workerid, pool, code, data=None):
-        if data:
-            data = json.dumps(data, indent=4, sort_keys=True)
-
-        rows = query("select appid from workers where workerid=%s", (workerid))
-        if 1 != len(rows):
-            throw(400, 'INVALID_MSG_DESTINATION')
-
-        appid = rows[0]['appid']
-
-        query("""insert into messages
-                 set workerid=%s, appid=%s, senderid=%s,
-                     pool=%s, state='queued', code=%s, data=%s
-              """, (workerid, appid, req['workerid'], pool, code, data))
-
-    def get_lock_holder(lockname):
-        row = query("""select workerid from locks where lockname=%s and appid=%s
-                       order by sequence limit 1""", (lockname, appid))
-        if len(row) < 1:
-            return None
-        else:
-            return row[0]['workerid']
-
     if 'lock' in req:
-        for lockname in set(req['lock']):
-            query("insert into locks set lockname=%s, appid=%s, workerid=%s",
-                  (lockname, appid, req['workerid']))
-
-        counter = 0
-        for lockname in set(req['lock']):
-            row = query("""select workerid from locks
-                           where lockname=%s and appid=%s
-                           order by sequence limit 1""", (lockname, appid))
-
-            if row[0]['workerid'] == req['workerid']:
-                counter += 1
-
-        if len(set(req['lock'])) == counter:
-            insert_message(req['workerid'], pool, 'locked')
+        if acquire_locks(req['workerid'], req['lock']):
+            push_message(req['workerid'], req['workerid'], pool, 'locked')
 
     if 'unlock' in req:
-        for lockname in set(req['unlock']):
-            query("""delete from locks
-                     where lockname=%s and appid=%s and workerid=%s
-                  """, (lockname, appid, req['workerid']))
-
-        to_be_unlocked = set()
-        for lockname in set(req['unlock']):
-            other_workerid = get_lock_holder(lockname)
-
-            if other_workerid:
-                locks = query("""select lockname from locks
-                                 where appid=%s and workerid=%s
-                              """, (appid, other_workerid))
-
-                counter = 0
-                for l in locks:
-                    tmp_workerid = get_lock_holder(l['lockname'])
-                    if other_workerid == tmp_workerid:
-                        counter += 1
-
-                if len(locks) == counter:
-                    to_be_unlocked.add(other_workerid)
-
-        for w in to_be_unlocked:
-            insert_message(w, 'default', 'locked')
-            mark_head(w)
+        for w in release_locks(req['workerid'], req['unlock']):
+            push_message(w, req['workerid'], 'default', 'locked')
 
     if 'message' in req:
         for workerid, msg in req['message'].iteritems():
-            insert_message(workerid,
-                           msg.get('pool', 'default'),
-                           msg['code'],
-                           msg.get('data', None))
-            mark_head(workerid)
+            push_message(workerid, req['workerid'],
+                         msg.get('pool', 'default'),
+                         msg['code'],
+                         msg.get('data', None))
 
     if 'alarm' in req:
         if int(req['alarm']) < 1:
@@ -532,68 +1290,302 @@ def commit_impl():
                  where appid=%s and workerid=%s and code='alarm'
               """, (appid, req['workerid']))
 
-        query("""insert into messages
-                 set workerid=%s, appid=%s, senderid=%s,
-                     pool=%s, state='queued',
-                     code='alarm', timestamp=now()+interval %s second
-              """,
-              (req['workerid'], appid, req['workerid'], pool, req['alarm']))
+        push_message(req['workerid'], req['workerid'], pool, 'alarm',
+                     delay=req['alarm'])
 
-    mark_head(req['workerid'])
+    advance_head(req['workerid'])
 
     query("update workers set status=%s, continuation=%s where workerid=%s",
-          (json.dumps(req['status'], indent=4, sort_keys=True),
-           json.dumps(req['continuation'], indent=4, sort_keys=True),
+          (encode(req['status']),
+           encode(req['continuation']),
            req['workerid']))
 
     return 'OK'
 
 
+def claim_messages(limit):
+    app = conf['apps'][appid]
+
+    promote_timers()
+
+    pools = [p for p, ips in (app.get('pools') or {}).iteritems()
+             if clientip in ips]
+    if clientip in app['hosts']:
+        pools.append('default')
+
+    # skip_locked needs MySQL 8, otherwise rows are claimed by update.
+    skip_locked = conf['mysql'].get('skip_locked', False)
+    locking = 'for update skip locked' if skip_locked else ''
+
+    rows = list()
+    for pool in pools:
+        if len(rows) >= limit:
+            break
+
+        rows.extend(query("""select msgid, workerid, code, data, senderid, pool
+                             from messages
+                             where state='head' and lock_ip is null and
+                                   appid=%s and pool=%s
+                             order by priority, msgid limit %s
+                          """ + locking, (appid, pool, limit - len(rows))))
+
+    if not rows:
+        return list()
+
+    if skip_locked:
+        query("update messages set lock_ip=%s where msgid in %s",
+              (clientip, [r['msgid'] for r in rows]))
+    else:
+        claimed = list()
+        for r in rows:
+            query("""update messages set lock_ip=%s
+                     where msgid=%s and lock_ip is null""",
+                  (clientip, r['msgid']))
+            if 1 == db_cursor.rowcount:
+                claimed.append(r)
+
+        rows = claimed
+        if not rows:
+            return list()
+
+    workerids = [r['workerid'] for r in rows]
+
+    query("update workers set session=session+1 where workerid in %s",
+          (workerids,))
+
+    workers = dict([(w['workerid'], w) for w in query(
+        """select workerid, continuation, session from workers
+           where workerid in %s""", (workerids,))])
+
+    result = list()
+    for r in rows:
+        worker = workers[r['workerid']]
+
+        msg = dict(msgid=r['msgid'],
+                   workerid=r['workerid'],
+                   session=worker['session'],
+                   continuation=decode(worker['continuation']),
+                   code=r['code'],
+                   senderid=r['senderid'],
+                   pool=r['pool'])
+
+        if r['data']:
+            msg['data'] = decode(r['data'])
+
+        result.append(msg)
+
+    return result
+
+
+def waiters_full(longpoll):
+    if waiters >= int(longpoll['max_waiters']):
+        return True
+
+    host_waiters = int(longpoll['host_waiters'])
+    if host_waiters and os.path.isdir(longpoll['dir']):
+        return len(os.listdir(longpoll['dir'])) >= host_waiters
+
+    return False
+
+
+def wait_for_messages(limit, timeout):
+    global waiters
+
+    longpoll = longpoll_conf()
+    with waiters_lock:
+        if waiters_full(longpoll):
+            return list()
+        waiters += 1
+
+    try:
+        return wait_on_listener(limit, timeout, longpoll)
+    finally:
+        with waiters_lock:
+            waiters -= 1
+
+
+def wait_on_listener(limit, timeout, longpoll):
+    deadline = time.time() + min(timeout, float(longpoll['timeout']))
+
+    # Bound before looking again, so an insert in between is not missed.
+    listener = Listener(appid)
+    try:
+        while True:
+            db_conn.commit()
+
+            msgs = claim_messages(limit)
+            if msgs or (time.time() >= deadline):
+                return msgs
+
+            # Release this attempt's locks and snapshot before sleeping.
+            db_conn.commit()
+            if notify_appids:
+                wakeup(notify_appids)
+                notify_appids.clear()
+
+            listener.wait(min(float(longpoll['interval']),
+                              deadline - time.time()))
+    finally:
+        listener.close()
+
+
 @transaction('/lockmessage', methods=['POST'])
 def lockmessage_post():
-    pools = copy.deepcopy(conf['apps'][appid]['pools'])
-    pools['default'] = conf['apps'][appid]['hosts'].keys()
+    args = req or {}
 
-    for pool in pools.keys():
-        if clientip not in pools[pool]:
-            continue
+    limit = max(1, min(int(args.get('max', 1)), 100))
+    msgs = claim_messages(limit)
 
-        rows = query("""select msgid, workerid, code, data, senderid
-                        from messages
-                        where timestamp < now() and state='head' and
-                        appid=%s and pool=%s and lock_ip is null
-                        order by priority limit 1""", (appid, pool))
+    if (not msgs) and (float(args.get('wait', 0)) > 0):
+        msgs = wait_for_messages(limit, float(args['wait']))
 
-        if len(rows) > 0:
-            query("update messages set lock_ip=%s where msgid=%s",
-                  (clientip, rows[0]['msgid']))
-            query("""update workers set session=session+1
-                     where workerid=%s""", (rows[0]['workerid']))
+    if 'max' in args:
+        return msgs
 
-            worker = query("""select continuation, session from workers
-                              where workerid=%s""", (rows[0]['workerid']))[0]
+    return msgs[0] if msgs else 'NOT_FOUND'
 
-            result = dict(msgid=rows[0]['msgid'],
-                          workerid=rows[0]['workerid'],
-                          session=worker['session'],
-                          continuation=json.loads(worker['continuation']),
-                          code=rows[0]['code'],
-                          senderid=rows[0]['senderid'],
-                          pool=pool)
+regex = re.compile('^\[(.+?) (\d+) (\d+) (\d{6}\.\d{6}\.\d{6}) (.+?)\] : ')
 
-            if rows[0]['data']:
-                result['data'] = json.loads(rows[0]['data'])
+index_cache = dict(pid=None, path=None, conn=None)
+index_lock = threading.Lock()
 
-            return result
 
-    return 'NOT_FOUND'
+def get_index(logs):
+    path = os.path.join(os.path.abspath(logs['dir']), 'index.db')
 
-regex = re.compile('^\[(.+?) (\d+) (\d+) (\d{6}\.\d{6}\.\d{6}) (.+?)\] : ')
+    if (index_cache['pid'] == os.getpid()) and (index_cache['path'] == path):
+        return index_cache['conn']
+
+    if index_cache['pid'] == os.getpid():
+        index_cache['conn'].close()
+
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute('pragma journal_mode=wal')
+    conn.execute('pragma synchronous=normal')
+    conn.execute("""create table if not exists offsets(thread text,
+        session integer, timestamp text, logfile text,
+        begin integer, end integer, primary key(thread, session))""")
+    conn.execute("create index if not exists timestamp on offsets(timestamp)")
+    conn.execute("""create table if not exists files(logfile text,
+        processed integer, primary key(logfile))""")
+    conn.execute("""create table if not exists ranges(thread text,
+        session integer, logfile text, begin integer, end integer,
+        primary key(thread, session, logfile, begin))""")
+    conn.execute("""create table if not exists blobs(md5 text,
+        logfile text, offset integer, length integer, primary key(md5))""")
+    try:
+        conn.execute("""create virtual table if not exists search using fts5(
+            message, thread unindexed, session unindexed,
+            sequence unindexed, timestamp unindexed)""")
+    except sqlite3.OperationalError:
+        conn.execute("""create virtual table if not exists search using fts4(
+            message, thread, session, sequence, timestamp)""")
+    conn.commit()
+
+    index_cache.update(pid=os.getpid(), path=path, conn=conn)
+    return conn
+
+
+def read_range(fd, begin, end):
+    os.lseek(fd, begin, os.SEEK_SET)
+
+    chunks = list()
+    while begin < end:
+        chunk = os.read(fd, end - begin)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        begin += len(chunk)
+
+    return ''.join(chunks)
+
+
+def index_log(conn, logfile, fd, size, data):
+    row = conn.execute("select processed from files where logfile=?",
+                       (logfile,)).fetchone()
+    processed = row[0] if row else 0
+
+    # Only the unterminated tail of the previous upload is read back.
+    buf = read_range(fd, processed, size) + data if processed < size else data
+
+    # The last record may be cut, so it is parsed again with the next chunk.
+    boffsets = dict()
+    eoffsets = dict()
+    spans = dict()
+    blobs = dict()
+    texts = list()
+    pos = tail = 0
+    while pos < len(buf):
+        eol = buf.find('\n', pos) + 1 or len(buf)
+
+        m = regex.match(buf[pos:eol])
+        if m:
+            key = (m.group(1), m.group(2))
+            if key not in boffsets:
+                boffsets[key] = (m.group(4), processed + pos)
+            eoffsets[key] = processed + eol
+
+            span = spans.setdefault(key, list())
+            if span and (span[-1][1] == processed + pos):
+                span[-1][1] = processed + eol
+            else:
+                span.append([processed + pos, processed + eol])
+
+            if 'BLOB' == m.group(5):
+                hdr = '[{0} {1} {2} {3} {4}]'.format(*m.groups())
+                blobs[hashlib.md5(hdr).hexdigest()] = (processed + pos,
+                                                       eol - pos)
+            else:
+                texts.append((processed + pos, buf[pos:eol][len(m.group(0)):],
+                              m.group(1), m.group(2), m.group(3), m.group(4)))
+        tail, pos = pos, eol
+
+    if not buf.endswith('\n'):
+        pos = tail
+
+    with conn:
+        # Keyed by file and offset, so a record parsed again replaces its row.
+        fileno = conn.execute("select rowid from files where logfile=?",
+                              (logfile,)).fetchone()
+        if fileno:
+            fileno = fileno[0]
+        else:
+            fileno = conn.execute("insert into files values(?, 0)",
+                                  (logfile,)).lastrowid
+
+        conn.execute("delete from search where rowid=?",
+                     ((fileno << 40) | processed,))
+        conn.executemany("""insert into search(rowid, message, thread,
+            session, sequence, timestamp) values(?,?,?,?,?,?)""",
+                         [((fileno << 40) | t[0],) + t[1:] for t in texts])
+
+        conn.executemany("insert or ignore into offsets values(?,?,?,?,?,0)",
+                         [(k[0], k[1], v[0], logfile, v[1])
+                             for k, v in boffsets.iteritems()])
+        conn.executemany("""update offsets set end=?
+            where thread=? and session=?""",
+                         [(v, k[0], k[1]) for k, v in eoffsets.iteritems()])
+        conn.execute("update files set processed=? where logfile=?",
+                     (processed + pos, logfile))
+        conn.executemany("insert or replace into blobs values(?,?,?,?)",
+                         [(k, logfile, v[0], v[1])
+                          for k, v in blobs.iteritems()])
+
+        for key, span in spans.iteritems():
+            begin, end = span[0]
+            cursor = conn.execute("""update ranges set end=max(end, ?)
+                where thread=? and session=? and logfile=?
+                and begin<=? and end>=?""",
+                (end, key[0], key[1], logfile, begin, begin))
+            conn.executemany("""insert or replace into ranges
+                values(?,?,?,?,?)""",
+                [(key[0], key[1], logfile, b, e)
+                 for b, e in span[1 if cursor.rowcount else 0:]])
 
 
 @application.route('/log/<logfile>/<size>', methods=['POST'])
 def log_put(logfile, size):
-    conf = yaml.load(open(conf_file))
+    conf = get_config()
     os.chdir(conf['logs']['dir'])
 
     logdir = flask.request.headers.get('X-Real-IP', flask.request.remote_addr)
@@ -604,58 +1596,312 @@ def log_put(logfile, size):
         if not os.path.isdir(logdir):
             os.makedirs(logdir)
 
-        fd = os.open(logfile, os.O_CREAT | os.O_WRONLY | os.O_APPEND)
+        fd = os.open(logfile, os.O_CREAT | os.O_RDWR | os.O_APPEND)
         fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
 
-        if os.fstat(fd).st_size == int(size):
-            os.write(fd, flask.request.data)
+        # Compacted, so report the logical size and take no more writes.
+        if os.path.exists(logfile + '.z'):
+            if 0 == os.fstat(fd).st_size:
+                os.unlink(logfile)
+
+            with open(logfile + '.z', 'rb') as file:
+                return json_response(dict(
+                    size=LogReader.read_index(file)[0]))
+
+        data = flask.request.data
+        if 'gzip' == flask.request.headers.get('Content-Encoding'):
+            data = zlib.decompress(data, 31) if data else ''
+
+        offset = os.fstat(fd).st_size
+        if offset == int(size):
+            data = data[:os.write(fd, data)] if data else ''
+        else:
+            data = ''
+
+        with index_lock:
+            index_log(get_index(conf['logs']), logfile, fd, offset, data)
 
         result = dict(size=os.fstat(fd).st_size)
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+    return json_response(result)
+
+
+class LogReader(object):
+    """Reads a plain log file or its .z segment by logical offset."""
+    footer = struct.Struct('<4sQQI')
+    indexes = dict()
+
+    def __init__(self, logfile):
+        self.logfile = logfile
+        self.block = None
+        self.mm = None
+        self.ends = None
+
+        try:
+            self.file = open(logfile, 'rb')
+        except IOError as e:
+            if errno.ENOENT != e.errno:
+                raise
+
+            self.file = open(logfile + '.z', 'rb')
+            self.size, self.bsize, self.ends = self.read_index(self.file)
+            return
+
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            self.mm = mmap.mmap(self.file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+
+    @classmethod
+    def read_index(cls, file):
+        st = os.fstat(file.fileno())
+        stat = (st.st_ino, st.st_mtime, st.st_size)
+
+        cached = cls.indexes.get(file.name)
+        if cached and (cached[0] == stat):
+            return cached[1]
+
+        file.seek(-cls.footer.size, os.SEEK_END)
+        magic, size, start, bsize = cls.footer.unpack(
+            file.read(cls.footer.size))
+        if 'SHZ1' != magic:
+            raise IOError(errno.EINVAL, 'not a log segment', file.name)
+
+        count = (st.st_size - cls.footer.size - start) // 8
+        file.seek(start)
+        ends = struct.unpack('<{0}Q'.format(count), file.read(count * 8))
+
+        cls.indexes[file.name] = (stat, (size, bsize, ends))
+        return size, bsize, ends
+
+    def load(self, n):
+        if (self.block is None) or (self.block[0] != n):
+            begin = self.ends[n-1] if n else 0
+            self.file.seek(begin)
+            self.block = (n, zlib.decompress(
+                self.file.read(self.ends[n] - begin)))
+
+        return self.block[1]
+
+    def read(self, offset, length):
+        if self.ends is None:
+            return self.mm[offset:offset + length] if self.mm else ''
+
+        chunks = list()
+        end = min(offset + length, self.size)
+        while offset < end:
+            n = offset // self.bsize
+            begin = offset - (n * self.bsize)
+            chunk = self.load(n)[begin:begin + end - offset]
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+            offset += len(chunk)
+
+        return ''.join(chunks)
+
+    def eol(self, offset):
+        if self.ends is None:
+            i = self.mm.find('\n', offset) if self.mm else -1
+            return (i + 1) if (i >= 0) else self.size
+
+        while offset < self.size:
+            n = offset // self.bsize
+            i = self.load(n).find('\n', offset - (n * self.bsize))
+            if i >= 0:
+                return (n * self.bsize) + i + 1
+            offset = (n + 1) * self.bsize
+
+        return self.size
+
+    def lines(self, begin, end):
+        while begin < end:
+            # Reads stop at end, past it only to finish the last line.
+            stop = self.eol(min(begin + 65536, end) - 1)
+            data = self.read(begin, stop - begin)
+            if not data:
+                return
+
+            i = 0
+            while i < len(data):
+                eol = (data.find('\n', i) + 1) or len(data)
+                yield begin + i, data[i:eol]
+                i = eol
+            begin += len(data)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.file.close()
+
+
+def compact_log(logfile, bsize):
+    fd = os.open(logfile, os.O_RDONLY)
+    try:
+        # Still being uploaded, tried again on the next run.
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+
+        segment = logfile + '.z'
+        with open(segment + '.tmp', 'wb') as out:
+            size = 0
+            ends = list()
+            while True:
+                chunk = os.read(fd, bsize)
+                if not chunk:
+                    break
+
+                out.write(zlib.compress(chunk, 9))
+                ends.append(out.tell())
+                size += len(chunk)
+
+            start = out.tell()
+            out.write(struct.pack('<{0}Q'.format(len(ends)), *ends))
+            out.write(LogReader.footer.pack('SHZ1', size, start, bsize))
+            out.flush()
+            os.fsync(out.fileno())
+
+        os.rename(segment + '.tmp', segment)
+        os.unlink(logfile)
+        return True
     finally:
         os.close(fd)
 
-    conn = sqlite3.connect('index.db')
-    conn.execute("""create table if not exists offsets(thread text,
-        session integer, timestamp text, logfile text,
-        begin integer, end integer, primary key(thread, session))""")
-    conn.execute("create index if not exists timestamp on offsets(timestamp)")
-    conn.execute("""create table if not exists files(logfile text,
-        processed integer, primary key(logfile))""")
-    processed = conn.execute("select processed from files where logfile=?",
-                             (logfile,)).fetchone()
-    if processed:
-        processed = processed[0]
-    else:
-        processed = 0
-        conn.execute("insert into files values(?, 0)", (logfile,))
-        conn.commit()
-    conn.close()
 
-    with open(logfile, 'r') as file:
-        file.seek(processed)
-        boffsets = dict()
-        eoffsets = dict()
-        for line in file:
+def compact_logs(conf):
+    logs = conf['logs']
+    os.chdir(logs['dir'])
+
+    bsize = int(logs.get('block', 65536))
+    cutoff = time.strftime('%y%m%d', time.gmtime(
+        time.time() - 86400 * int(logs.get('compact_after', 3))))
+
+    # Agents stop shipping a file once it is older than yesterday.
+    for logdir in os.listdir('.'):
+        if not os.path.isdir(logdir):
+            continue
+
+        for name in sorted(os.listdir(logdir)):
+            if re.match('^log\.\d{6}$', name) and (name[4:] < cutoff):
+                compact_log(os.path.join(logdir, name), bsize)
+
+
+def log_reader(readers, logfile):
+    if logfile not in readers:
+        readers[logfile] = LogReader(logfile)
+
+    return readers[logfile]
+
+
+def scan_lines(readers, thread, session, logfile, begin, end):
+    reader = log_reader(readers, logfile)
+    for offset, line in reader.lines(begin, end + 1):
+        m = regex.match(line)
+        if m and (thread == m.group(1)) and (str(session) == m.group(2)):
+            yield logfile, offset, line, m
+
+
+def range_lines(readers, ranges):
+    for logfile, begin, end in ranges:
+        for offset, line in log_reader(readers, logfile).lines(begin, end):
             m = regex.match(line)
             if m:
-                key = (m.group(1), m.group(2))
-                if key not in boffsets:
-                    boffsets[key] = (m.group(4), processed)
-                eoffsets[key] = processed + len(line)
-            processed += len(line)
+                yield logfile, offset, line, m
+
+
+def link_blobs(conn, blobs, refs):
+    links = dict([(md5, blobs[md5]) for md5 in refs if md5 in blobs])
+
+    # Blobs logged in an earlier chunk or session are found in the index.
+    missing = [md5 for md5 in refs if md5 not in blobs]
+    if missing:
+        links.update([(r[0], '/blobs/{0}'.format(r[0])) for r in conn.execute(
+            "select md5 from blobs where md5 in ({0})".format(
+                ','.join(['?'] * len(missing))), missing)])
+
+    return links
+
+
+def session_records(path, thread, sessions, after):
+    conn = sqlite3.connect(path)
+    readers = dict()
+    try:
+        for s, offsets in sessions:
+            ranges = conn.execute("""select logfile, begin, end from ranges
+                where thread=? and session=? order by logfile, begin""",
+                (thread, s)).fetchall()
+
+            # Sessions indexed before ranges existed are scanned.
+            if ranges and (ranges[0][:2] == offsets[:2]):
+                lines = range_lines(readers, ranges)
+            else:
+                lines = scan_lines(readers, thread, s, *offsets)
+
+            blobs = dict()
+            for logfile, begin, line, m in lines:
+                seq, timestamp, tag = int(m.group(3)), m.group(4), m.group(5)
+                if 'BLOB' == tag:
+                    hdr = '[{0} {1} {2} {3} {4}]'.format(
+                        m.group(1), m.group(2), seq, timestamp, tag)
+                    blobs[hashlib.md5(hdr).hexdigest()] = \
+                        '/blob/{0}/{1}'.format(logfile, begin)
+                elif (s, seq) > after:
+                    msg = line[len(m.group(0)):].rstrip('\n')
+                    yield s, seq, timestamp, tag, msg, link_blobs(
+                        conn, blobs, re.findall('<<(\w{32})>>', msg))
+    finally:
+        for reader in readers.values():
+            reader.close()
+        conn.close()
+
+
+def html_record(s, seq, timestamp, tag, msg, blobs):
+    msg = cgi.escape(msg)
+    for m in re.finditer('([-\w]+)&lt;&lt;(\w{32})&gt;&gt;', msg):
+        if m.group(2) in blobs:
+            msg = msg.replace(m.group(0), '<a href="{0}">{1}</a>'.format(
+                blobs[m.group(2)], m.group(1)))
+    for m in re.finditer('&lt;&lt;(\w{32})&gt;&gt;', msg):
+        if m.group(1) in blobs:
+            msg = msg.replace(m.group(0), '<a href="{0}">blob</a>'.format(
+                blobs[m.group(1)]))
+
+    tag = tag.replace(',', ' ') + ' SESSION-' + str(s)
+    return ('<tr class="{0}"><td class="timestamp">{1}</td><td>{2}</td></tr>'
+            .format(tag, timestamp, msg))
+
+
+@application.route('/logs/search', methods=['GET'])
+def logs_search():
+    conf = get_config()
+    os.chdir(conf['logs']['dir'])
+
+    begin = flask.request.args.get('begin', '0')
+    end = flask.request.args.get('end', '9')
+    limit = flask.request.args.get('limit', 100)
 
     conn = sqlite3.connect('index.db')
-    conn.executemany("insert or ignore into offsets values(?,?,?,?,?,0)",
-                     [(k[0], k[1], v[0], logfile, v[1])
-                         for k, v in boffsets.iteritems()])
-    conn.executemany("update offsets set end=? where thread=? and session=?",
-                     [(v, k[0], k[1]) for k, v in eoffsets.iteritems()])
-    conn.execute("update files set processed=? where logfile=?",
-                 (processed, logfile))
-    conn.commit()
-    conn.close()
+    try:
+        rows = conn.execute("""select thread, session, sequence, timestamp
+            from search where search match ?
+            and timestamp > ? and timestamp < ?
+            order by timestamp desc limit ?""",
+            (flask.request.args.get('q', ''), begin, end, limit)).fetchall()
+    except sqlite3.OperationalError as e:
+        return json_response(str(e), 400)
+    finally:
+        conn.close()
 
-    return json_response(result)
+    return json_response([dict(thread=r[0], session=int(r[1]),
+                               sequence=int(r[2]), timestamp=r[3],
+                               url='/logs/{0}/{1}'.format(r[0], r[1]))
+                          for r in rows])
 
 
 @application.route('/logs', methods=['GET'])
@@ -663,12 +1909,13 @@ def log_put(logfile, size):
 @application.route('/logs/<thread>/sessions', methods=['GET'])
 @application.route('/logs/<thread>/<session>', methods=['GET'])
 def logs_get(thread=None, session=None):
-    conf = yaml.load(open(conf_file))
+    conf = get_config()
     os.chdir(conf['logs']['dir'])
 
     begin = flask.request.args.get('begin', '0')
     end = flask.request.args.get('end', '9')
     limit = flask.request.args.get('limit', 25)
+    as_json = 'json' == flask.request.args.get('format')
 
     conn = sqlite3.connect('index.db')
 
@@ -679,6 +1926,10 @@ def logs_get(thread=None, session=None):
             limit ?""", (begin, end, limit)).fetchall()
         conn.close()
 
+        if as_json:
+            return json_response([dict(thread=r[0], timestamp=r[1],
+                                       sessions=r[2]) for r in result])
+
         return html_table_response(''.join(['''<tr>
             <td><a href="{0}">{1}</a></td>
             <td><a href="{2}">{3} sessions</a></td>
@@ -690,13 +1941,28 @@ def logs_get(thread=None, session=None):
         result = conn.execute("""select session, timestamp from offsets
             where thread=? order by timestamp desc""", (thread,)).fetchall()
         conn.close()
+
+        if as_json:
+            return json_response([dict(session=r[0], timestamp=r[1])
+                                  for r in result])
+
         return html_table_response(''.join([
             '<tr><td><a href="{0}">{1}</a></td><td>{2}</td></tr>'.format(
                 '/logs/{0}/{1}'.format(thread, r[0]), r[0], r[1])
             for r in result]))
 
+    try:
+        after = [int(x) for x in
+                 flask.request.args.get('after', '0.0').split('.')]
+        after = (after[0], after[1] if len(after) > 1 else 0)
+        lines = max(1, int(flask.request.args.get('lines', 1000)))
+    except ValueError as e:
+        conn.close()
+        return json_response(str(e), 400)
+
     rows = conn.execute("""select session, logfile, begin, end
-        from offsets where thread=?""", (thread,)).fetchall()
+        from offsets where thread=? and session>=? order by session""",
+        (thread, after[0])).fetchall()
     conn.close()
 
     if session:
@@ -705,76 +1971,87 @@ def logs_get(thread=None, session=None):
             r = (l[0], l[1]) if (len(l) > 1) else (l[0], l[0])
             for n in range(int(r[0]), int(r[1])+1):
                 sset.add(n)
-        sdict = dict([(x[0], (x[1], x[2], x[3]))
-                     for x in rows if x[0] in sset])
-    else:
-        sdict = dict([(r[0], (r[1], r[2], r[3])) for r in rows])
+        rows = [x for x in rows if x[0] in sset]
 
-    result = list()
-    for s in sorted(sdict.keys()):
-        logfile, begin, end = sdict[s]
+    records = session_records(
+        os.path.join(os.path.abspath(conf['logs']['dir']), 'index.db'),
+        thread, [(x[0], (x[1], x[2], x[3])) for x in rows], after)
 
-        with open(logfile, 'r') as file:
-            file.seek(begin)
+    page = dict(next=None)
+    url = flask.request.path + '?lines={0}{1}'.format(
+        lines, '&format=json' if as_json else '')
 
-            blobs = dict()
-            for line in file:
-                if begin > end:
-                    break
+    def paginate():
+        last = None
+        for n, record in enumerate(records):
+            if n == lines:
+                page['next'] = '{0}&after={1}.{2}'.format(url, *last[:2])
+                break
 
-                m = regex.match(line)
-                if m and (thread == m.group(1)) and (str(s) == m.group(2)):
-                    seq, timestamp, tag = m.group(3), m.group(4), m.group(5)
-                    if 'BLOB' == tag:
-                        hdr = '[{0} {1} {2} {3} {4}]'.format(
-                            m.group(1), m.group(2), seq, timestamp, tag)
-                        blobs[hashlib.md5(hdr).hexdigest()] = begin
-                    else:
-                        msg = cgi.escape(line[len(m.group(0)):])
-                        find_pattern = '([-\w]+)&lt;&lt;(\w{32})&gt;&gt;'
-                        for m in re.finditer(find_pattern, msg):
-                            if m.group(2) in blobs:
-                                msg = msg.replace(
-                                    m.group(0),
-                                    '<a href="/blob/{0}/{1}">{2}</a>'
-                                    .format(logfile, blobs[m.group(2)],
-                                            m.group(1)))
-                        for m in re.finditer('&lt;&lt;(\w{32})&gt;&gt;', msg):
-                            if m.group(1) in blobs:
-                                msg = msg.replace(
-                                    m.group(0),
-                                    '<a href="/blob/{0}/{1}">blob</a>'
-                                    .format(logfile, blobs[m.group(1)]))
-
-                        tag = tag.replace(',', ' ') + ' SESSION-' + str(s)
-                        result.append((timestamp, tag, msg))
-                begin += len(line)
+            last = record
+            yield record
 
-    return html_table_response(''.join([
-        '<tr class="{0}"><td class="timestamp">{1}</td><td>{2}</td></tr>'
-        .format(r[1], r[0], r[2]) for r in result]))
+    if as_json:
+        return json_list_stream(
+            (dict(session=r[0], sequence=r[1], timestamp=r[2], tag=r[3],
+                  message=r[4], blobs=r[5]) for r in paginate()), page)
+
+    def rows_html():
+        for record in paginate():
+            yield html_record(*record)
+
+        if page['next']:
+            yield '<tr><td></td><td><a href="{0}">more</a></td></tr>'.format(
+                cgi.escape(page['next'], True))
+
+    return html_table_stream(rows_html())
+
+
+def blob_response(logfile, offset, length=None):
+    reader = LogReader(logfile)
+    try:
+        if length:
+            line = reader.read(int(offset), int(length))
+        else:
+            line = next(reader.lines(int(offset), int(offset) + 1), (0, ''))[1]
+    finally:
+        reader.close()
+
+    m = regex.match(line)
+    if m:
+        return flask.Response(base64.b64decode(line[len(m.group(0)):]),
+                              200, mimetype='text/plain')
+
+    return flask.Response('NOT FOUND', 402, mimetype='text/plain')
 
 
 @application.route('/blob/<ip>/<logfile>/<offset>', methods=['GET'])
 def blob_get(ip, logfile, offset):
-    conf = yaml.load(open(conf_file))
+    conf = get_config()
     os.chdir(conf['logs']['dir'])
 
-    with open(os.path.join(ip, logfile)) as file:
-        file.seek(int(offset))
+    return blob_response(os.path.join(ip, logfile), offset)
 
-        line = file.readline()
-        m = regex.match(line)
-        if m:
-            return flask.Response(base64.b64decode(line[len(m.group(0)):]),
-                                  200, mimetype='text/plain')
 
-    return flask.Response('NOT FOUND', 402, mimetype='text/plain')
+@application.route('/blobs/<md5>', methods=['GET'])
+def blobs_get(md5):
+    conf = get_config()
+    os.chdir(conf['logs']['dir'])
+
+    conn = sqlite3.connect('index.db')
+    row = conn.execute("select logfile, offset, length from blobs where md5=?",
+                       (md5,)).fetchone()
+    conn.close()
+
+    if row is None:
+        return flask.Response('NOT FOUND', 404, mimetype='text/plain')
+
+    return blob_response(*row)
 
 
 @application.route('/config', methods=['GET'])
 def config_get():
-    conf = yaml.load(open(conf_file))
+    conf = get_config()
     c = copy.deepcopy(conf)
 
     if ('mysql' in c) and ('password' in c['mysql']):
@@ -790,3 +2067,9 @@ def config_get():
 def index():
     return flask.Response('\n'.join([conf_file, config, schema]),
                           200, mimetype='text/plain')
+
+
+if '__main__' == __name__:
+    # Run from cron as "python shepherd.py compact" to archive old logs.
+    if 'compact' in sys.argv[1:]:
+        compact_logs(get_config())